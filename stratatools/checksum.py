@@ -13,7 +13,7 @@ class Checksum:
 
 class Crc16_Checksum(Checksum):
     def __init__(self):
-        self.table = [
+        self.table = (
             0x0000, 0xC0C1, 0xC181, 0x0140, 0xC301, 0x03C0, 0x0280, 0xC241,
             0xC601, 0x06C0, 0x0780, 0xC741, 0x0500, 0xC5C1, 0xC481, 0x0440,
             0xCC01, 0x0CC0, 0x0D80, 0xCD41, 0x0F00, 0xCFC1, 0xCE81, 0x0E40,
@@ -45,10 +45,15 @@ class Crc16_Checksum(Checksum):
             0x8801, 0x48C0, 0x4980, 0x8941, 0x4B00, 0x8BC1, 0x8A81, 0x4A40,
             0x4E00, 0x8EC1, 0x8F81, 0x4F40, 0x8D01, 0x4DC0, 0x4C80, 0x8C41,
             0x4400, 0x84C1, 0x8581, 0x4540, 0x8701, 0x47C0, 0x4680, 0x8641,
-            0x8201, 0x42C0, 0x4380, 0x8341, 0x4100, 0x81C1, 0x8081, 0x4040]
+            0x8201, 0x42C0, 0x4380, 0x8341, 0x4100, 0x81C1, 0x8081, 0x4040)
 
     def checksum(self, data, crc=0):
+        # Iterating over a memoryview yields characters on python 2
+        if isinstance(data, memoryview):
+            data = data.tolist()
+
+        table = self.table
         for byte in data:
-            crc = self.table[(crc ^ byte) & 0xff] ^ (crc >> 8) & 0xffff
+            crc = table[(crc ^ byte) & 0xff] ^ (crc >> 8) & 0xffff
         return crc
 
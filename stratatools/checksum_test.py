@@ -9,3 +9,11 @@ class TestCrc16(unittest.TestCase):
         crc16 = crc.checksum(bytearray("abcd"))
 
         assert expected_crc16 == crc16
+
+    def test_checksum_memoryview(self):
+        expected_crc16 = 14743
+
+        crc = checksum.Crc16_Checksum()
+        crc16 = crc.checksum(memoryview(bytearray("--abcd--"))[2:6])
+
+        assert expected_crc16 == crc16
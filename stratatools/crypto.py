@@ -13,11 +13,24 @@ class Crypto():
     def encrypt(self, key, plaintext):
         pass
 
+    #
+    # Encrypt plaintext into the writable buffer ciphertext, of the same length
+    #
+    def encrypt_into(self, key, plaintext, ciphertext):
+        ciphertext[:] = self.encrypt(key, plaintext)
+
     def decrypt(self, key, ciphertext):
         pass
 
+    #
+    # Decrypt ciphertext into the writable buffer plaintext, of the same length
+    #
+    def decrypt_into(self, key, ciphertext, plaintext):
+        plaintext[:] = self.decrypt(key, ciphertext)
+
 class Desx_Crypto(Crypto):
     def __init__(self):
+        self.cipher = None
         self.clorox = [
                 0xBD,0x56,0xEA,0xF2,0xA2,0xF1,0xAC,0x2A,0xB0,0x93,0xD1,
                 0x9C,0x1B,0x33,0xFD,0xD0,0x30,0x04,0xB6,0xDC,0x7D,0xDF,
@@ -65,33 +78,60 @@ class Desx_Crypto(Crypto):
 
         return (input_whitener, output_whitener)
 
-    def encrypt(self, key, plaintext):
-        (input_whitening_key, output_whitening_key) = self.build_whitening_keys(key)
+    #
+    # Every block is whitened then encrypted on its own (DES in ECB mode), so
+    # the whole buffer can go through a single DES call. The key schedule and
+    # whitening keys are kept for the last key used, since a cartridge is
+    # always processed with the same key.
+    #
+    def build_cipher(self, key):
+        key = bytes(key)
+
+        # Read and replaced as a single tuple, so concurrent callers with
+        # different keys never mix each other's cipher
+        cipher = self.cipher
+        if cipher is None or cipher[0] != key:
+            (input_whitening_key, output_whitening_key) = self.build_whitening_keys(bytearray(key))
+            des = DES.new(key[0:8], DES.MODE_ECB)
+            cipher = (key, des, input_whitening_key, output_whitening_key)
+            self.cipher = cipher
+
+        return cipher[1:]
 
+    def encrypt(self, key, plaintext):
         ciphertext = bytearray(len(plaintext))
+        self.encrypt_into(key, plaintext, ciphertext)
+        return ciphertext
 
+    #
+    # plaintext and ciphertext may be the same buffer
+    #
+    def encrypt_into(self, key, plaintext, ciphertext):
         if (len(plaintext) % 8):
             raise Exception("plaintext length must be a multiple of 8")
+        assert len(plaintext) == len(ciphertext)
 
-        des = DES.new(str(key[0:8]), DES.MODE_CBC, str(bytearray(8))).encrypt
-        for i in range(len(plaintext)/8):
-            ciphertext[i*8:i*8+8] = strxor(output_whitening_key, des(strxor(input_whitening_key, str(plaintext[i*8:i*8+8]))))
+        (des, input_whitening_key, output_whitening_key) = self.build_cipher(key)
+        blocks = len(plaintext) // 8
 
-            des = DES.new(str(key[0:8]), DES.MODE_CBC, str(bytearray(8))).encrypt
-
-        return ciphertext
+        des.encrypt(strxor(input_whitening_key * blocks, plaintext), output=ciphertext)
+        strxor(output_whitening_key * blocks, ciphertext, output=ciphertext)
 
     def decrypt(self, key, ciphertext):
-        (input_whitening_key, output_whitening_key) = self.build_whitening_keys(key)
-
         plaintext = bytearray(len(ciphertext))
+        self.decrypt_into(key, ciphertext, plaintext)
+        return plaintext
 
+    #
+    # ciphertext and plaintext may be the same buffer
+    #
+    def decrypt_into(self, key, ciphertext, plaintext):
         if (len(ciphertext) % 8):
             raise Exception("ciphertext length must be a multiple of 8")
+        assert len(ciphertext) == len(plaintext)
 
-        des = DES.new(str(key[0:8]), DES.MODE_CBC, str(bytearray(8))).decrypt
-        for i in range(len(ciphertext)/8):
-            plaintext[i*8:i*8+8] = bytearray(strxor(input_whitening_key, des(strxor(output_whitening_key, str(ciphertext[i*8:i*8+8])))))
-            des = DES.new(str(key[0:8]), DES.MODE_CBC, str(bytearray(8))).decrypt
+        (des, input_whitening_key, output_whitening_key) = self.build_cipher(key)
+        blocks = len(ciphertext) // 8
 
-        return plaintext
+        des.decrypt(strxor(output_whitening_key * blocks, ciphertext), output=plaintext)
+        strxor(input_whitening_key * blocks, plaintext, output=plaintext)
@@ -21,3 +21,12 @@ class TestCrypto(unittest.TestCase):
         plaintext = desx.decrypt(DESX_KEY, desx.encrypt(DESX_KEY, expected_plaintext))
 
         assert expected_plaintext == plaintext
+
+    def test_desx_encrypt_memoryview(self):
+        expected_ciphertext = bytearray(b"\x38\xdb\x9b\xe0\x9d\x1b\x24\xa0\x7c\x77\x49\x26\xaf\x94\xe8\xd5")
+
+        desx = Desx_Crypto()
+
+        ciphertext = desx.encrypt(DESX_KEY, memoryview(bytearray("--this is a test..--"))[2:18])
+
+        assert expected_ciphertext == ciphertext
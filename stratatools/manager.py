@@ -2,7 +2,9 @@
 # See the LICENSE file
 #
 
-import datetime
+import binascii
+import calendar
+import operator
 import struct
 import time
 
@@ -28,23 +30,140 @@ import material
 #        0x58   : 0x08 - Current material quantity (double)
 #        0x60   : 0x02 - Current material quantity crypted CRC (unencrypted, uint16)
 #        0x62   : 0x02 - Current material quantity CRC (unencrypted, uint16)
+#        0x68   : 0x09 - Signature (string)
 #       ~~~~~~~~~~~~~
 #       14 0x00: 0x48 - crypted/plaintext (start, len)
 #       15 0x58: 0x10 - unknown, looks like DEX IV, but why?
 #       16 0x48: 0x10 - ^
 
+# Field offsets, see the layout above
+_OFF_SERIAL_NUMBER = 0x00
+_OFF_MATERIAL = 0x08
+_OFF_LOT = 0x10
+_OFF_VERSION = 0x24
+_OFF_MFG_DATE = 0x28
+_OFF_USE_DATE = 0x30
+_OFF_INITIAL_QTY = 0x38
+_OFF_CONTENT_CRC = 0x40
+_OFF_CRYPTED_CONTENT_CRC = 0x46
+_OFF_KEY = 0x48
+_OFF_KEY_CRC = 0x50
+_OFF_CURRENT_QTY = 0x58
+_OFF_CRYPTED_CURRENT_QTY_CRC = 0x60
+_OFF_CURRENT_QTY_CRC = 0x62
+_OFF_SIGNATURE = 0x68
+
+# Size of the EEPROM image, up to the end of the signature (0x68 + 9)
+_EEPROM_LEN = 0x71
+
+# Ranges checksummed and encrypted
+_CONTENT = slice(_OFF_SERIAL_NUMBER, _OFF_CONTENT_CRC)
+_KEY = slice(_OFF_KEY, _OFF_KEY_CRC)
+_CURRENT_QTY = slice(_OFF_CURRENT_QTY, _OFF_CRYPTED_CURRENT_QTY_CRC)
+
+# Content and current material quantity, gathered to be encrypted together
+_CRYPTED_BLOCKS_LEN = 0x48
+_CRYPTED_BLOCKS_CONTENT = slice(0x00, 0x40)
+_CRYPTED_BLOCKS_CURRENT_QTY = slice(0x40, 0x48)
+
+# Precompiled struct formats used to pack/unpack the EEPROM fields
+_S_H = struct.Struct("<H")
+# Plaintext content, 0x00 to 0x40: serial number, material, lot, version,
+# manufacturing date, use date and initial material quantity
+_EEPROM_FMT = struct.Struct("<dd20sH2xHBBBBHHBBBBHd")
+# Tail, 0x40 to 0x71: key, current material quantity and signature. Checksums
+# are written afterwards, every other byte is padding and zeroed.
+_EEPROM_TAIL_FMT = struct.Struct("<8x8s8xd8x9s")
+
+assert _S_H.size == 2
+assert _EEPROM_FMT.size == _OFF_CONTENT_CRC
+assert struct.calcsize("<d") == _OFF_MATERIAL
+assert struct.calcsize("<dd") == _OFF_LOT
+assert struct.calcsize("<dd20s") == _OFF_VERSION
+assert struct.calcsize("<dd20sH2x") == _OFF_MFG_DATE
+assert struct.calcsize("<dd20sH2xHBBBBH") == _OFF_USE_DATE
+assert struct.calcsize("<dd20sH2xHBBBBHHBBBBH") == _OFF_INITIAL_QTY
+assert _OFF_CONTENT_CRC + struct.calcsize("<8x") == _OFF_KEY
+assert _OFF_CONTENT_CRC + struct.calcsize("<8x8s8x") == _OFF_CURRENT_QTY
+assert _OFF_CONTENT_CRC + struct.calcsize("<8x8s8xd8x") == _OFF_SIGNATURE
+assert _OFF_CONTENT_CRC + _EEPROM_TAIL_FMT.size == _EEPROM_LEN
+
+# Key byte order, indexing cartridge key (0-7) + machine number (8-15) + eeprom uid (16-23)
+_KEY_PERMUTATION = operator.itemgetter(0, 2, 18, 6, 8, 10, 22, 14, 15, 17, 11, 9, 7, 21, 3, 1)
+# Translation table inverting every byte of the key
+_KEY_INVERT = bytes(bytearray(~i & 0xff for i in range(256)))
+
+# Number of encoded cartridges remembered by Manager.encode
+_ENCODE_CACHE_SIZE = 256
+# Doubles added to the Manager.encode cache key
+_CACHE_DOUBLES = struct.Struct("<ddd")
+
+#
+# Reject years datetime.datetime cannot represent
+#
+def _check_year(year):
+    if not 1 <= year <= 9999:
+        raise ValueError("year %d is out of range" % year)
+
+#
+# Convert a date to a UTC timestamp, rejecting out of range fields the same
+# way datetime.datetime does
+#
+def _timestamp_from_date(year, month, day, hour, minute, second):
+    _check_year(year)
+    if not 1 <= month <= 12:
+        raise ValueError("month must be in 1..12")
+    if not 1 <= day <= calendar.monthrange(year, month)[1]:
+        raise ValueError("day is out of range for month")
+    if not 0 <= hour <= 23:
+        raise ValueError("hour must be in 0..23")
+    if not 0 <= minute <= 59:
+        raise ValueError("minute must be in 0..59")
+    if not 0 <= second <= 59:
+        raise ValueError("second must be in 0..59")
+
+    return calendar.timegm((year, month, day, hour, minute, second))
+
 class Manager:
     def __init__(self, crypto, checksum):
         self.crypto = crypto
         self.checksum = checksum
+        self.encode_cache = {}
 
     #
     # Encode a cartridge object into a data that can be burn onto a cartridge
     #
+    # Results are cached on the serialized cartridge, a copy is returned so
+    # the caller is free to modify it. Replacing crypto or checksum makes the
+    # cached results stale.
+    #
     def encode(self, machine_number, eeprom_uid, cartridge):
-        cartridge_packed = self.pack(cartridge)
-        cartridge_crypted = self.encrypt(machine_number, eeprom_uid, cartridge_packed)
-        return cartridge_crypted
+        # proto3 does not serialize -0.0, the raw doubles tell it from 0.0
+        cache_key = (bytes(machine_number),
+                bytes(eeprom_uid),
+                cartridge.SerializeToString(),
+                _CACHE_DOUBLES.pack(cartridge.serial_number,
+                    cartridge.initial_material_quantity,
+                    cartridge.current_material_quantity))
+
+        cartridge_crypted = self.encode_cache.get(cache_key)
+        if cartridge_crypted is None:
+            cartridge_crypted = bytearray(_EEPROM_LEN)
+            self.encode_into(cartridge_crypted, machine_number, eeprom_uid, cartridge)
+
+            if len(self.encode_cache) >= _ENCODE_CACHE_SIZE:
+                self.encode_cache.clear()
+            self.encode_cache[cache_key] = cartridge_crypted
+
+        return bytearray(cartridge_crypted)
+
+    #
+    # Encode a cartridge object into a writable buffer of at least
+    # _EEPROM_LEN bytes, packing and encrypting in place
+    #
+    def encode_into(self, eeprom, machine_number, eeprom_uid, cartridge):
+        self.pack_into(eeprom, cartridge)
+        self.encrypt(machine_number, eeprom_uid, eeprom)
 
     #
     # Decode a eeprom to a cartridge object
@@ -59,113 +178,148 @@ class Manager:
     # onto the cartridge EEPROM
     #
     def pack(self, cartridge):
-        eeprom = bytearray(0x71)
-
-        # serial number
-        struct.pack_into("<d", eeprom, 0x0, cartridge.serial_number)
-        # material id
-        struct.pack_into("<d", eeprom, 0x08, material.get_id_from_name(cartridge.material_name))
-        # manufacturing lot
-        struct.pack_into("<20s", eeprom, 0x10, str(cartridge.manufacturing_lot))
-        # version (not sure)
-        struct.pack_into("<H", eeprom, 0x24, cartridge.version)
-        # manufacturing date
-        mfg_dt = cartridge.manufacturing_date.ToDatetime()
-        struct.pack_into("<HBBBBH", eeprom, 0x28,
-                mfg_dt.year - 1900,
-                mfg_dt.month,
-                mfg_dt.day,
-                mfg_dt.hour,
-                mfg_dt.minute,
-                mfg_dt.second)
-        # last use date
-        lu_dt = cartridge.last_use_date.ToDatetime()
-        struct.pack_into("<HBBBBH", eeprom, 0x30,
-                lu_dt.year - 1900,
-                lu_dt.month,
-                lu_dt.day,
-                lu_dt.hour,
-                lu_dt.minute,
-                lu_dt.second)
-        struct.pack_into("<d", eeprom, 0x38, cartridge.initial_material_quantity)
+        eeprom = bytearray(_EEPROM_LEN)
+        self.pack_into(eeprom, cartridge)
+        return eeprom
+
+    #
+    # Pack a cartridge into a writable buffer of at least _EEPROM_LEN bytes
+    #
+    def pack_into(self, eeprom, cartridge):
+        mfg_tm = time.gmtime(cartridge.manufacturing_date.seconds)
+        lu_tm = time.gmtime(cartridge.last_use_date.seconds)
+        _check_year(mfg_tm.tm_year)
+        _check_year(lu_tm.tm_year)
+        _EEPROM_FMT.pack_into(eeprom, _OFF_SERIAL_NUMBER,
+                # serial number
+                cartridge.serial_number,
+                # material id
+                material.get_id_from_name(cartridge.material_name),
+                # manufacturing lot
+                str(cartridge.manufacturing_lot),
+                # version (not sure)
+                cartridge.version,
+                # manufacturing date
+                mfg_tm.tm_year - 1900,
+                mfg_tm.tm_mon,
+                mfg_tm.tm_mday,
+                mfg_tm.tm_hour,
+                mfg_tm.tm_min,
+                mfg_tm.tm_sec,
+                # last use date
+                lu_tm.tm_year - 1900,
+                lu_tm.tm_mon,
+                lu_tm.tm_mday,
+                lu_tm.tm_hour,
+                lu_tm.tm_min,
+                lu_tm.tm_sec,
+                # initial material quantity
+                cartridge.initial_material_quantity)
+        _EEPROM_TAIL_FMT.pack_into(eeprom, _OFF_CONTENT_CRC,
+                # key
+                binascii.unhexlify(cartridge.key_fragment),
+                # current material quantity
+                cartridge.current_material_quantity,
+                # signature (not sure, not usedu)
+                str(cartridge.signature))
+
+        eeprom_view = memoryview(eeprom)
         # plaintext checksum
-        struct.pack_into("<H", eeprom, 0x40, self.checksum.checksum(eeprom[0x00:0x40]))
-        # key
-        struct.pack_into("<8s", eeprom, 0x48, str(cartridge.key_fragment.decode("hex")))
+        _S_H.pack_into(eeprom, _OFF_CONTENT_CRC, self.checksum.checksum(eeprom_view[_CONTENT]))
         # key checksum
-        struct.pack_into("<H", eeprom, 0x50, self.checksum.checksum(eeprom[0x48:0x50]))
-        # current material quantity
-        struct.pack_into("<d", eeprom, 0x58, cartridge.current_material_quantity)
+        _S_H.pack_into(eeprom, _OFF_KEY_CRC, self.checksum.checksum(eeprom_view[_KEY]))
         # Checksum current material quantity
-        struct.pack_into("<H", eeprom, 0x62, self.checksum.checksum(eeprom[0x58:0x60]))
-        # signature (not sure, not usedu)
-        struct.pack_into("<9s", eeprom, 0x68, str(cartridge.signature))
+        _S_H.pack_into(eeprom, _OFF_CURRENT_QTY_CRC, self.checksum.checksum(eeprom_view[_CURRENT_QTY]))
+
+    #
+    # Pack many cartridges into a single contiguous buffer, one
+    # _EEPROM_LEN record after the other
+    #
+    def pack_many(self, cartridges):
+        eeprom = bytearray(_EEPROM_LEN * len(cartridges))
+        eeprom_view = memoryview(eeprom)
+
+        for (i, cartridge) in enumerate(cartridges):
+            self.pack_into(eeprom_view[i * _EEPROM_LEN:(i + 1) * _EEPROM_LEN], cartridge)
 
         return eeprom
 
+    #
+    # Unpack a buffer of contiguous decrypted cartridges, as built by pack_many
+    #
+    def unpack_many(self, cartridges_packed):
+        if len(cartridges_packed) % _EEPROM_LEN:
+            raise ValueError("packed cartridges length must be a multiple of %#x" % _EEPROM_LEN)
+
+        cartridges_view = memoryview(cartridges_packed)
+
+        return [self.unpack(cartridges_view[offset:offset + _EEPROM_LEN])
+                for offset in range(0, len(cartridges_packed), _EEPROM_LEN)]
+
     #
     # Unpack a decrypted cartridge into a catridge object
     #
     def unpack(self, cartridge_packed):
+        cartridge_packed = memoryview(cartridge_packed)
+
         # Validating plaintext checksum
-        if self.checksum.checksum(cartridge_packed[0x00:0x40]) != struct.unpack("<H", str(cartridge_packed[0x40:0x42]))[0]:
-            raise Exception("invalid content checksum: should have " + hex(struct.unpack("<H", str(cartridge_packed[0x40:0x42]))[0]) + " but have " + hex(self.checksum.checksum(cartridge_packed[0x00:0x40])))
+        plain_checksum = self.checksum.checksum(cartridge_packed[_CONTENT])
+        stored_checksum = _S_H.unpack_from(cartridge_packed, _OFF_CONTENT_CRC)[0]
+        if plain_checksum != stored_checksum:
+            raise ValueError("invalid content checksum: should have %#x but have %#x" % (stored_checksum, plain_checksum))
 
         # Validating current material quantity checksum
-        if self.checksum.checksum(cartridge_packed[0x58:0x60]) != struct.unpack("<H", str(cartridge_packed[0x62:0x64]))[0]:
-            raise Exception("invalid current material quantity checksum")
-
-        cartridge_packed = buffer(cartridge_packed)
+        if self.checksum.checksum(cartridge_packed[_CURRENT_QTY]) != _S_H.unpack_from(cartridge_packed, _OFF_CURRENT_QTY_CRC)[0]:
+            raise ValueError("invalid current material quantity checksum")
 
-        # Serial number
-        serial_number = struct.unpack_from("<d", cartridge_packed, 0x0)[0]
-        # Material
-        material_name = material.get_name_from_id(int(struct.unpack_from("<d", cartridge_packed, 0x08)[0]))
-        # Manufacturing lot
-        manufacturing_lot = struct.unpack_from("<20s", cartridge_packed, 0x10)[0].split('\x00')[0]
-        # Manufacturing datetime
-        (mfg_datetime_year,
+        (serial_number,
+            material_id,
+            manufacturing_lot,
+            version,
+            mfg_datetime_year,
             mfg_datetime_month,
             mfg_datetime_day,
             mfg_datetime_hour,
             mfg_datetime_minute,
-            mfg_datetime_second) = struct.unpack_from("<HBBBBH", cartridge_packed, 0x28)
-        mfg_datetime = datetime.datetime(mfg_datetime_year + 1900,
+            mfg_datetime_second,
+            use_datetime_year,
+            use_datetime_month,
+            use_datetime_day,
+            use_datetime_hour,
+            use_datetime_minute,
+            use_datetime_second,
+            initial_material_quantity) = _EEPROM_FMT.unpack_from(cartridge_packed, _OFF_SERIAL_NUMBER)
+        (key_fragment,
+            current_material_quantity,
+            signature) = _EEPROM_TAIL_FMT.unpack_from(cartridge_packed, _OFF_CONTENT_CRC)
+
+        # Material
+        material_name = material.get_name_from_id(int(material_id))
+        # Manufacturing lot
+        manufacturing_lot = manufacturing_lot.split('\x00')[0]
+        # Manufacturing datetime
+        mfg_timestamp = _timestamp_from_date(mfg_datetime_year + 1900,
                 mfg_datetime_month,
                 mfg_datetime_day,
                 mfg_datetime_hour,
                 mfg_datetime_minute,
                 mfg_datetime_second)
         # Last use datetime
-        (use_datetime_year,
-            use_datetime_month,
-            use_datetime_day,
-            use_datetime_hour,
-            use_datetime_minute,
-            use_datetime_second) = struct.unpack_from("<HBBBBH", cartridge_packed, 0x30)
-        use_datetime = datetime.datetime(use_datetime_year + 1900,
+        use_timestamp = _timestamp_from_date(use_datetime_year + 1900,
                 use_datetime_month,
                 use_datetime_day,
                 use_datetime_hour,
                 use_datetime_minute,
                 use_datetime_second)
-        # Initial material quantity
-        initial_material_quantity = struct.unpack_from("<d", cartridge_packed, 0x38)[0]
-        # Version
-        version = struct.unpack_from("<H", cartridge_packed, 0x24)[0]
         # Key fragment
-        key_fragment = str(struct.unpack_from("<8s", cartridge_packed, 0x48)[0]).encode("hex")
-        # Current material quantity
-        current_material_quantity = struct.unpack_from("<d", cartridge_packed, 0x58)[0]
-        # Signature
-        signature = struct.unpack_from("<9s", cartridge_packed, 0x68)[0]
+        key_fragment = binascii.hexlify(key_fragment)
 
         c = cartridge_pb2.Cartridge()
         c.serial_number = serial_number
         c.material_name = material_name
         c.manufacturing_lot = manufacturing_lot
-        c.manufacturing_date.FromDatetime(mfg_datetime)
-        c.last_use_date.FromDatetime(use_datetime)
+        c.manufacturing_date.seconds = mfg_timestamp
+        c.last_use_date.seconds = use_timestamp
         c.initial_material_quantity = initial_material_quantity
         c.current_material_quantity = current_material_quantity
         c.key_fragment = key_fragment
@@ -183,16 +337,23 @@ class Manager:
         # Validate key fragment checksum
         # TODO
 
+        cartridge_view = memoryview(cartridge_packed)
+
         # Build the key
-        key = self.build_key(cartridge_packed[0x48:0x50], machine_number, eeprom_uid)
-        # Encrypt content
-        struct.pack_into("<64s", cartridge_crypted, 0x00, str(self.crypto.encrypt(key, cartridge_packed[0x00:0x40])))
+        key = self.build_key(cartridge_view[_KEY], machine_number, eeprom_uid)
+        # Encrypt content and current material quantity with a single call,
+        # every 8 bytes block is encrypted independently
+        blocks = bytearray(_CRYPTED_BLOCKS_LEN)
+        blocks_view = memoryview(blocks)
+        blocks_view[_CRYPTED_BLOCKS_CONTENT] = cartridge_view[_CONTENT]
+        blocks_view[_CRYPTED_BLOCKS_CURRENT_QTY] = cartridge_view[_CURRENT_QTY]
+        self.crypto.encrypt_into(key, blocks_view, blocks_view)
+        cartridge_view[_CONTENT] = blocks_view[_CRYPTED_BLOCKS_CONTENT]
+        cartridge_view[_CURRENT_QTY] = blocks_view[_CRYPTED_BLOCKS_CURRENT_QTY]
         # Checksum crypted content
-        struct.pack_into("<H", cartridge_crypted, 0x46, self.checksum.checksum(cartridge_packed[0x00:0x40]))
-        # Encrypt current material quantity
-        struct.pack_into("<8s", cartridge_crypted, 0x58, str(self.crypto.encrypt(key, cartridge_packed[0x58:0x60])))
+        _S_H.pack_into(cartridge_crypted, _OFF_CRYPTED_CONTENT_CRC, self.checksum.checksum(cartridge_view[_CONTENT]))
         # Checksum crypted current material quantity
-        struct.pack_into("<H", cartridge_crypted, 0x60, self.checksum.checksum(cartridge_packed[0x58:0x60]))
+        _S_H.pack_into(cartridge_crypted, _OFF_CRYPTED_CURRENT_QTY_CRC, self.checksum.checksum(cartridge_view[_CURRENT_QTY]))
 
         return cartridge_crypted
 
@@ -205,18 +366,25 @@ class Manager:
         # Validate key fragment checksum
         # TODO
 
+        cartridge_view = memoryview(cartridge_crypted)
+
         # Build the key
-        key = self.build_key(cartridge_crypted[0x48:0x50], machine_number, eeprom_uid)
+        key = self.build_key(cartridge_view[_KEY], machine_number, eeprom_uid)
         # Validate crypted content checksum
-        if self.checksum.checksum(cartridge_crypted[0x00:0x40]) != struct.unpack("<H", str(cartridge_crypted[0x46:0x48]))[0]:
-            raise Exception("invalid crypted content checksum")
-        # Decrypt content
-        cartridge_packed[0x00:0x40] = self.crypto.decrypt(key, cartridge_crypted[0x00:0x40])
+        if self.checksum.checksum(cartridge_view[_CONTENT]) != _S_H.unpack_from(cartridge_view, _OFF_CRYPTED_CONTENT_CRC)[0]:
+            raise ValueError("invalid crypted content checksum")
         # Validate crypted current material quantity checksum
-        if self.checksum.checksum(cartridge_crypted[0x58:0x60]) != struct.unpack("<H", str(cartridge_crypted[0x60:0x62]))[0]:
-            raise Exception("invalid current material quantity checksum")
-        # Decrypt current material quantity
-        cartridge_packed[0x58:0x60] = self.crypto.decrypt(key, cartridge_crypted[0x58:0x60])
+        if self.checksum.checksum(cartridge_view[_CURRENT_QTY]) != _S_H.unpack_from(cartridge_view, _OFF_CRYPTED_CURRENT_QTY_CRC)[0]:
+            raise ValueError("invalid current material quantity checksum")
+        # Decrypt content and current material quantity with a single call,
+        # every 8 bytes block is decrypted independently
+        blocks = bytearray(_CRYPTED_BLOCKS_LEN)
+        blocks_view = memoryview(blocks)
+        blocks_view[_CRYPTED_BLOCKS_CONTENT] = cartridge_view[_CONTENT]
+        blocks_view[_CRYPTED_BLOCKS_CURRENT_QTY] = cartridge_view[_CURRENT_QTY]
+        self.crypto.decrypt_into(key, blocks_view, blocks_view)
+        cartridge_view[_CONTENT] = blocks_view[_CRYPTED_BLOCKS_CONTENT]
+        cartridge_view[_CURRENT_QTY] = blocks_view[_CRYPTED_BLOCKS_CURRENT_QTY]
 
         return cartridge_packed
 
@@ -224,26 +392,8 @@ class Manager:
     # Build a key used to encrypt/decrypt a cartridge
     #
     def build_key(self, cartridge_key, machine_number, eeprom_uid):
-        machine_number = bytearray(machine_number)
-        eeprom_uid = bytearray(eeprom_uid)
-        key = bytearray(16)
-
-        key[0] = ~cartridge_key[0] & 0xff
-        key[1] = ~cartridge_key[2] & 0xff
-        key[2] = ~eeprom_uid[2] & 0xff
-        key[3] = ~cartridge_key[6] & 0xff
-        key[4] = ~machine_number[0] & 0xff
-        key[5] = ~machine_number[2] & 0xff
-        key[6] = ~eeprom_uid[6] & 0xff
-        key[7] = ~machine_number[6] & 0xff
-        key[8] = ~machine_number[7] & 0xff
-        key[9] = ~eeprom_uid[1] & 0xff
-        key[10] = ~machine_number[3] & 0xff
-        key[11] = ~machine_number[1] & 0xff
-        key[12] = ~cartridge_key[7] & 0xff
-        key[13] = ~eeprom_uid[5] & 0xff
-        key[14] = ~cartridge_key[3] & 0xff
-        key[15] = ~cartridge_key[1] & 0xff
-
-        return key
+        key = bytearray(memoryview(cartridge_key)[0:8]) + bytearray(machine_number[0:8]) + bytearray(eeprom_uid[0:8])
+        if len(key) != 24:
+            raise ValueError("cartridge key, machine number and eeprom uid must be 8 bytes each")
 
+        return bytearray(_KEY_PERMUTATION(key)).translate(_KEY_INVERT)
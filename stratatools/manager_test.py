@@ -1,4 +1,5 @@
 import binascii
+import struct
 import unittest
 
 from stratatools.manager import Manager
@@ -30,6 +31,9 @@ PACKED_CARTRIDGE_HEX = ("0000000000489340000000000000f03f35363738000000000000"
                         "4344dc2f00000000000000000040333336400000e8d400000000"
                         "544553545445535431")
 
+MACHINE_NUMBER = binascii.unhexlify("2c30478bb7de81e8")
+EEPROM_UID = binascii.unhexlify("2362474d0100006b")
+
 
 class TestManager(unittest.TestCase):
     def test_pack(self):
@@ -55,3 +59,116 @@ class TestManager(unittest.TestCase):
         unpacked_cartridge = manager.unpack(manager.pack(expected_cartridge))
 
         assert expected_cartridge == unpacked_cartridge
+
+    def test_pack_many_unpack_many(self):
+        cartridge = Cartridge()
+        Merge(CARTRIDGE_TEXT, cartridge)
+        other_cartridge = Cartridge()
+        Merge(CARTRIDGE_TEXT, other_cartridge)
+        other_cartridge.serial_number = 4321.0
+
+        crypto = Desx_Crypto()
+        checksum = Crc16_Checksum()
+        manager = Manager(crypto, checksum)
+        packed_eeproms = manager.pack_many([cartridge, other_cartridge])
+
+        assert manager.pack(cartridge) + manager.pack(other_cartridge) == packed_eeproms
+
+        packed_eeprom = bytearray(b"\xff" * 0x71)
+        manager.pack_into(packed_eeprom, cartridge)
+        assert manager.pack(cartridge) == packed_eeprom
+        assert [cartridge, other_cartridge] == manager.unpack_many(packed_eeproms)
+
+    def test_unpack_invalid_checksum(self):
+        packed_eeprom = bytearray(binascii.unhexlify(PACKED_CARTRIDGE_HEX))
+        packed_eeprom[0x00] ^= 0xff
+
+        crypto = Desx_Crypto()
+        checksum = Crc16_Checksum()
+        manager = Manager(crypto, checksum)
+
+        with self.assertRaises(ValueError):
+            manager.unpack(packed_eeprom)
+
+    def test_encode_into(self):
+        cartridge = Cartridge()
+        Merge(CARTRIDGE_TEXT, cartridge)
+
+        crypto = Desx_Crypto()
+        checksum = Crc16_Checksum()
+        manager = Manager(crypto, checksum)
+        expected_eeprom = manager.encode(MACHINE_NUMBER, EEPROM_UID, cartridge)
+
+        eeprom = bytearray(b"\xff" * 0x80)
+        manager.encode_into(memoryview(eeprom)[0x08:0x79], MACHINE_NUMBER, EEPROM_UID, cartridge)
+
+        assert expected_eeprom == eeprom[0x08:0x79]
+        assert cartridge == manager.decode(MACHINE_NUMBER, EEPROM_UID, eeprom[0x08:0x79])
+
+    def test_encode_cache(self):
+        cartridge = Cartridge()
+        Merge(CARTRIDGE_TEXT, cartridge)
+
+        crypto = Desx_Crypto()
+        checksum = Crc16_Checksum()
+        manager = Manager(crypto, checksum)
+        eeprom = manager.encode(MACHINE_NUMBER, EEPROM_UID, cartridge)
+        eeprom[0x00] ^= 0xff
+
+        assert eeprom != manager.encode(MACHINE_NUMBER, EEPROM_UID, cartridge)
+
+        cartridge.current_material_quantity = 11.1
+        assert cartridge == manager.decode(MACHINE_NUMBER, EEPROM_UID, manager.encode(MACHINE_NUMBER, EEPROM_UID, cartridge))
+
+    def test_build_key_invalid_length(self):
+        crypto = Desx_Crypto()
+        checksum = Crc16_Checksum()
+        manager = Manager(crypto, checksum)
+        key = manager.build_key(b"ABCDABCD", MACHINE_NUMBER, EEPROM_UID)
+
+        assert key == manager.build_key(b"ABCDABCD", MACHINE_NUMBER + b"\x00", EEPROM_UID)
+        with self.assertRaises(ValueError):
+            manager.build_key(b"ABCDABCD", MACHINE_NUMBER[0:7], EEPROM_UID)
+
+    def test_unpack_invalid_date(self):
+        crypto = Desx_Crypto()
+        checksum = Crc16_Checksum()
+        manager = Manager(crypto, checksum)
+
+        for (offset, value) in ((0x2b, 0), (0x2b, 32), (0x2c, 24), (0x2d, 60), (0x2e, 60), (0x33, 0)):
+            packed_eeprom = bytearray(binascii.unhexlify(PACKED_CARTRIDGE_HEX))
+            packed_eeprom[offset] = value
+            packed_eeprom[0x40:0x42] = bytearray(struct.pack("<H", checksum.checksum(packed_eeprom[0x00:0x40])))
+
+            with self.assertRaises(ValueError):
+                manager.unpack(packed_eeprom)
+
+    def test_pack_invalid_date(self):
+        cartridge = Cartridge()
+        Merge(CARTRIDGE_TEXT, cartridge)
+        cartridge.manufacturing_date.seconds = 253402300800
+
+        crypto = Desx_Crypto()
+        checksum = Crc16_Checksum()
+        manager = Manager(crypto, checksum)
+
+        with self.assertRaises(ValueError):
+            manager.pack(cartridge)
+
+    def test_encode_cache_negative_zero(self):
+        cartridge = Cartridge()
+        Merge(CARTRIDGE_TEXT, cartridge)
+        other_cartridge = Cartridge()
+        Merge(CARTRIDGE_TEXT, other_cartridge)
+        cartridge.current_material_quantity = 0.0
+        other_cartridge.current_material_quantity = -0.0
+
+        crypto = Desx_Crypto()
+        checksum = Crc16_Checksum()
+        manager = Manager(crypto, checksum)
+        eeprom = manager.encode(MACHINE_NUMBER, EEPROM_UID, cartridge)
+        other_eeprom = manager.encode(MACHINE_NUMBER, EEPROM_UID, other_cartridge)
+
+        assert Manager(crypto, checksum).encode(MACHINE_NUMBER, EEPROM_UID, cartridge) == eeprom
+        assert Manager(crypto, checksum).encode(MACHINE_NUMBER, EEPROM_UID, other_cartridge) == other_eeprom
+        assert eeprom != other_eeprom
@@ -177,13 +177,11 @@ id_to_name[0x388] = "SR35_2"
 
 
 name_to_id = {}
+for key, value in enumerate(id_to_name):
+    name_to_id[value] = key
 
 def get_name_from_id(id):
     return id_to_name[id]
 
 def get_id_from_name(name):
-    if len(name_to_id) == 0:
-        for key, value in enumerate(id_to_name):
-            name_to_id[value] = key
-
     return name_to_id[name]